@@ -11,57 +11,123 @@ Some notes:
     Vertices can be created in any order, *but* faces must enumerate them
     in counterclockwise order; otherwise they will appear backwards (dark side
     to viewer) or broken (if neither CW nor CCW).
+
+    Set PS3D_TRACE in the environment to log the STACK as each word runs;
+    it is ignored when running with `python -O`.
 '''
-import sys, os, math, logging  # pylint: disable=multiple-imports
+import sys, os, io, re, math, logging  # pylint: disable=multiple-imports
 from ast import literal_eval
-from copy import deepcopy
 from collections import namedtuple
+from functools import partial
 from datetime import datetime
 
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
+# checked once, so hot loops can skip building debug messages altogether
+DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
+# STACK trace after every word, quadratic in output, so only on request
+TRACE = DEBUG and bool(os.getenv('PS3D_TRACE'))
 
 STACK = []
 GSTACK = []  # graphic state stack
-VERTEX = []
-FACE = []
+# (x, y, z) -> 0-based index of a vertex already written to the .obj file
+VERTEX_INDEX = {}
+FACE_FORMAT = {}  # 'f %d %d %d\n' and so on, by number of vertices
 OUTPUT = type('Files', (), {'obj': None, 'mtl': None})()
 BLACK = [0, 0, 0]
 WHITE = [1, 1, 1]
 COLOR = [WHITE]
+COLOR_INDEX = {tuple(WHITE): 0}  # (r, g, b) -> index into COLOR
 DEVICE = {
     'PageSize': [0, 0],
     'LineWidth': 1,
     'RGBColor': WHITE,  # black shows as white by default
     'Path': [],
-    'State': 'executing',
 }
+TOKEN = re.compile(r'\S+')  # anything between whitespace
+PARENS = re.compile(r'[()]')  # for finding the end of a (string)
+NUMBER = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')  # int or float
+COLINEAR = 1e-9  # radians; segments turning less than this are merged
+SNAP = 1 / 1024  # if set, vertices this close (in each axis) are merged
+SHEBANG = '%!ps3d'  # what ps3d input files must start with
+PS_SHEBANG = '%!ps'  # what plain PostScript files start with
 MM = 25.4 / 72  # 1/72" ~= .35mm; in case we want to convert
+# faces of each box built by `stroke`, as counterclockwise lists of indices
+# into its 8 vertices (see `build_segment_vertices` and `get_faces`)
+BOX_FACES = {
+    'top': (0, 1, 2, 3),
+    'bottom': (7, 6, 5, 4),
+    'left': (4, 5, 1, 0),
+    'right': (3, 2, 6, 7),
+    'start': (1, 5, 6, 2),
+    'end': (4, 0, 3, 7),
+}
 PS3D = {}  # words of the language
-# Triplet: x, y, z values that can be used in arithmetic operations with scalars
-Triplet = namedtuple(
-    'Triplet',
-    ('x', 'y', 'z', 'type'),
-    defaults=(0, 0, 0, None)
-)
-Triplet.__add__ = lambda self, other: Triplet(
-    self.x + other.x, self.y + other.y, self.z + other.z, other.type
-) if hasattr(other, 'x') else Triplet(
-    self.x + other, self.y + other, self.z + other, self.type
-)
-Triplet.__mul__ = lambda self, other: Triplet(  # only scalar
-    self.x * other, self.y * other, self.z * other, self.type
-)
-# check equality only for x, y, z
-Triplet.__eq__ = lambda self, other: self[:3] == other[:3]
+
+
+class Triplet(namedtuple('Triplet', ('x', 'y', 'z', 'type'),
+                         defaults=(0, 0, 0, None))):
+    '''
+    x, y, z values that can be used in arithmetic operations with scalars
+
+    `type` records how a path got to the point (moveto, lineto...); it plays
+    no part in comparisons, so equal points hash alike whatever their type
+
+    >>> Triplet(1, 2, 3, 'moveto') == Triplet(1, 2, 3)
+    True
+    >>> Triplet(1, 2, 3, 'moveto') != Triplet(1, 2, 3, 'lineto')
+    False
+    >>> Triplet(1, 2, 3) == (1, 2, 3), Triplet(1, 2, 3) != None
+    (False, True)
+    >>> Triplet(1, 2) + Triplet(3, 4, 5, 'lineto')
+    Triplet(x=4, y=6, z=5, type='lineto')
+    >>> Triplet(1, 2, 3) * 2
+    Triplet(x=2, y=4, z=6, type=None)
+    '''
+    __slots__ = ()
+
+    def __add__(self, other):
+        if isinstance(other, Triplet):
+            return Triplet(self.x + other.x, self.y + other.y,
+                           self.z + other.z, other.type)
+        return Triplet(self.x + other, self.y + other, self.z + other,
+                       self.type)
+
+    def __mul__(self, other):  # only scalar
+        return Triplet(self.x * other, self.y * other, self.z * other,
+                       self.type)
+
+    def __eq__(self, other):
+        if not isinstance(other, Triplet):
+            return NotImplemented
+        return (self.x == other.x and self.y == other.y and
+                self.z == other.z)
+
+    def __ne__(self, other):  # else tuple's, which would compare `type` too
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.z))
+
+class Procedure(list):
+    '''
+    a {procedure} compiled by `compile_ps3d`
+
+    pushed like any other literal, but run rather than pushed when it is
+    looked up by the name it was given with `def`
+    '''
+    __slots__ = ()
 
 def convert(infile=sys.stdin, objfile='stdout.obj', mtlfile='stdout.mtl'):
     '''
     convert .ps3d file to .obj format
     '''
+    VERTEX_INDEX.clear()
     if infile != sys.stdin:
         infile = open(infile)
-    OUTPUT.obj = open(objfile, 'w')
-    OUTPUT.mtl = open(mtlfile, 'w')
+    # output is built in memory and written out in one go when we're done
+    OUTPUT.obj = io.StringIO()
+    OUTPUT.mtl = io.StringIO()
     print(
         '# created %s from %s by %s' % (
             datetime.now(), infile.name, sys.argv[0]
@@ -75,296 +141,607 @@ def convert(infile=sys.stdin, objfile='stdout.obj', mtlfile='stdout.mtl'):
     print('g mtl0', file=OUTPUT.obj)
     print('usemtl mtl0', file=OUTPUT.obj)
     PS3D.update(ps3d())
-    process_file(infile)
-    infile.close()
-    OUTPUT.obj.close()
-    OUTPUT.mtl.close()
+    try:
+        process_file(infile)
+    finally:  # even on error, what was done so far can help debugging
+        infile.close()
+        for buffer, filename in ((OUTPUT.obj, objfile), (OUTPUT.mtl, mtlfile)):
+            with open(filename, 'w') as outfile:
+                outfile.write(buffer.getvalue())
+            buffer.close()
 
 def process_file(infile):
     '''
     reads and processes lines from an open filehandle
+
+    each line is compiled and then run; a procedure left open at the end
+    of a line is carried on with the lines that follow, each compiled only
+    once, and the line that closes it is run
     '''
     shebang = next(infile)
-    if not shebang.startswith('%!ps3d'):
-        if shebang.startswith('%!ps'):
+    if not shebang.startswith(SHEBANG):
+        if shebang.startswith(PS_SHEBANG):
             logging.warning('plain postscript (not ps3d) file!')
         else:
-            raise ValueError('Valid input should start with "%!ps3d"')
+            raise ValueError('Valid input should start with "%s"' % SHEBANG)
+    programs = [[]]  # the program, then any procedures still open
     for line in infile:
-        print('# ps code:', line.rstrip(), file=OUTPUT.obj)
-        process(line)
-
-def process(line):
+        OUTPUT.obj.write('# ps code: %s\n' % line.rstrip())
+        program = compile_ps3d(line, programs)
+        if len(programs) > 1:
+            continue  # procedure still open, needs the next line
+        programs[0] = []
+        execute(program)
+    if len(programs) > 1:
+        raise ValueError('Procedure not closed at end of file')
+
+def compile_ps3d(source, programs=None):
     '''
-    tokenize and interpret line of ps3d code
+    tokenize ps3d source code into a program that `execute` can run
+
+    a program is a list of (word, value) pairs. if word is None, value is a
+    literal to be pushed onto the STACK; otherwise word is the function to
+    call, and value is just its name. literals are evaluated, and the
+    built-in words looked up, only once, here. procedures in braces become
+    nested programs, pushed as literals. any other name is looked up only
+    when it is reached, by `call`, as it may not be defined until then.
+
+    raises EOFError if a procedure is still open at the end of the source,
+    unless `programs` is passed: compiling then carries on from where a
+    previous call left it, with any procedure still open left in it for the
+    next call to finish
+
+    >>> PS3D.update(ps3d())
+    >>> [value for word, value in compile_ps3d('1 2.5 /two (three) add')]
+    [1, 2.5, 'two', 'three', 'add']
+    >>> [value for word, value in compile_ps3d('-3 .5 1e3 007 [4]')]
+    [-3, 0.5, 1000.0, 7, [4]]
+    >>> compile_ps3d('{1 2 add}')[0][1][:2]
+    [(None, 1), (None, 2)]
+    >>> compile_ps3d('{1 {2}}')[0][1]
+    [(None, 1), (None, [(None, 2)])]
+    >>> programs = [[]]
+    >>> compile_ps3d('{1', programs), len(programs)
+    ([], 2)
+    >>> compile_ps3d('2}', programs), len(programs)
+    ([(None, [(None, 1), (None, 2)])], 1)
     '''
-    # pylint: disable=too-many-branches  # can be fixed with helper functions
-    tokens = line.split()
-    for token in tokens:
-        line = line.lstrip()[len(token):]
-        if token.startswith('%'):
-            print('#' + token[1:] + line.rstrip(), file=OUTPUT.obj)
+    check = programs is None
+    if check:
+        programs = [[]]  # the program, then any procedures being compiled
+    # walk the source with a cursor rather than re-slicing it for every token
+    position = 0
+    search, get_word = TOKEN.search, PS3D.get
+    get_compiler = COMPILER.get
+    while True:
+        match = search(source, position)
+        if match is None:
             break
-        if token.startswith('/'):
-            STACK.append(token[1:])  # store literal as string
+        token = match.group()
+        compiler = get_compiler(token[0])
+        if compiler is not None:  # %comment, /name, (string), { or }
+            position = compiler(source, match, programs)
             continue
-        if token.startswith('('):
-            string, line = extract_string(token + line)
-            STACK.append(string)
-            process(line)  # current token list is suspect, discard it
-            break
-        if token.startswith('{'):
-            DEVICE['State'] = 'compiling'
-            STACK.append([])  # list to hold compiled words
-            line = token[1:] + line
-            process(line)
-            break
+        position = match.end()
         if token.endswith('}'):
-            if token != '}':
-                # separate it into its own token
-                process(token[:-1] + ' }' + line)
-                break
-            DEVICE['state'] = 'executing'
-            continue
-
-        if token in PS3D:
-            if DEVICE['State'] != 'compiling':
-                logging.debug('processing `%s` with STACK %s', token, STACK)
-                PS3D[token]()
-            else:
-                STACK[-1].append(token)
+            # separate the braces, to be read next time around
+            token = token.rstrip('}')
+            position = match.start() + len(token)
+        program = programs[-1]
+        word = get_word(token)
+        if callable(word):
+            program.append((word, token))
+        elif NUMBER.match(token):  # by far the commonest literals
+            try:
+                program.append((None, int(token)))
+            except ValueError:
+                program.append((None, float(token)))
+        elif token[0].isalpha() and token not in ('True', 'False', 'None'):
+            # a name, maybe not yet defined; no use trying it as a literal
+            program.append((partial(call, token), token))
         else:
             try:
-                STACK.append(literal_eval(token))
-            except ValueError as bad:
-                raise ValueError('Unknown value ' + token) from bad
-        logging.debug('STACK: %s', STACK)
+                program.append((None, literal_eval(token)))
+            except ValueError:  # a name after all
+                program.append((partial(call, token), token))
+    if check and len(programs) > 1:
+        raise EOFError('Procedure not closed')
+    return programs[0]
+
+def compile_comment(source, match, programs):
+    '''
+    compile a %comment, up to the end of the line, for `compile_ps3d`
+
+    comments go to the .obj file even from inside a procedure, so they are
+    added to the outermost program. returns the position after the comment.
+    '''
+    start = match.start()
+    position = source.find('\n', start)
+    if position < 0:
+        position = len(source)
+    text = source[start + 1:position].rstrip()
+    programs[0].append((partial(comment, text), '%'))
+    return position
+
+def compile_name(source, match, programs):
+    '''
+    compile a /name for `compile_ps3d`: the name is stored as a literal string
+    '''
+    # pylint: disable=unused-argument  # same signature as the others
+    programs[-1].append((None, match.group()[1:]))
+    return match.end()
+
+def compile_string(source, match, programs):
+    '''
+    compile a (string) for `compile_ps3d`
+    '''
+    start = match.start()
+    position = string_end(source, start)
+    programs[-1].append((None, source[start + 1:position - 1]))
+    return position
+
+def open_procedure(source, match, programs):
+    '''
+    start compiling a {procedure} for `compile_ps3d`
+    '''
+    # pylint: disable=unused-argument  # same signature as the others
+    programs.append(Procedure())  # list to hold compiled words
+    return match.start() + 1
+
+def close_procedure(source, match, programs):
+    '''
+    finish a {procedure}, pushed as a literal by the program enclosing it
 
-def extract_string(line, index=1):
-    '''
-    get string encased with parentheses
-
-    should handle nested parentheses correctly
-    >>> extract_string('(this is a test) and this should remain')
-    ('this is a test', ' and this should remain')
-    '''
-    open_parens = 1  # count of nested parentheses, when zero we're done
-    string = None
-    while open_parens > 0:
-        try:
-            left = line.index('(', index)
-        except ValueError:  # assuming substring not found
-            left = sys.maxsize
-        right = line.index(')', index)  # let this raise ValueError if not found
-        if left < right:
-            open_parens += 1
-            string, remainder = extract_string(line, left + 1)
-            logging.debug('remainder: %s', remainder)  # avoids pylint warning
-            index += len(string)
+    a stray closing brace is ignored
+    '''
+    # pylint: disable=unused-argument  # same signature as the others
+    if len(programs) > 1:
+        procedure = programs.pop()
+        programs[-1].append((None, procedure))
+    return match.start() + 1
+
+# tokens handled by their first character rather than as words or literals
+COMPILER = {
+    '%': compile_comment,
+    '/': compile_name,
+    '(': compile_string,
+    '{': open_procedure,
+    '}': close_procedure,
+}
+
+def execute(program):
+    '''
+    run a program compiled by `compile_ps3d`
+
+    >>> PS3D.update(ps3d()); STACK[:] = []
+    >>> execute(compile_ps3d('/x 5 def /sum {x 2 add} def'))
+    >>> execute(compile_ps3d('sum x'))
+    >>> STACK
+    [7, 5]
+    >>> execute(compile_ps3d('nosuchword'))
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown value nosuchword
+    >>> STACK[:] = []
+    '''
+    push = STACK.append
+    for word, value in program:
+        if word is None:
+            push(value)
         else:
-            string = line[1:right]
-            line = line[right + 1:]
-            open_parens -= 1
-    return string, line
+            if TRACE:
+                logging.debug('processing `%s` with STACK %s', value, STACK)
+            word()
+    if TRACE:
+        logging.debug('STACK: %s', STACK)
+
+def call(name):
+    '''
+    run the word `name`, looked up now rather than when it was compiled
+
+    a procedure is run, any other definition pushed onto the STACK
+    '''
+    try:
+        definition = PS3D[name]
+    except KeyError:
+        raise ValueError('Unknown value ' + name) from None
+    if callable(definition):
+        definition()
+    elif isinstance(definition, Procedure):
+        execute(definition)
+    else:
+        STACK.append(definition)
 
-def atan2(point0, point1):
+def comment(text):
     '''
-    angle in positive degrees between two points in the xy plane
+    copy a ps3d comment into the .obj file
     '''
-    atan = math.degrees(math.atan2(
-        point1.y - point0.y, point1.x - point0.x
-    ))
-    # make sure it's positive
-    return (360 + atan) % 360
+    OUTPUT.obj.write('#%s\n' % text)
 
-def sin(theta):
+def popn(count):
+    '''
+    take the top `count` (at least 1) items off the STACK, in stack order
+
+    CPython lists already push and pop at the end in constant time; only
+    pop(-n) is costly, shifting what lies above, so taking several operands
+    is done with a single slice and delete
+
+    >>> STACK[:] = [1, 2, 3, 4]
+    >>> popn(3)
+    [2, 3, 4]
+    >>> STACK
+    [1]
+    >>> popn(2)
+    Traceback (most recent call last):
+        ...
+    IndexError: STACK underflow
     '''
-    y displacement for given angle theta (degrees)
+    if count > len(STACK):
+        raise IndexError('STACK underflow')
+    items = STACK[-count:]
+    del STACK[-count:]
+    return items
+
+def current_point():
     '''
-    return math.sin(math.radians(theta))
+    last point of the current path, as needed by the relative path words
 
-def cos(theta):
+    >>> DEVICE['Path'] = []
+    >>> current_point()
+    Traceback (most recent call last):
+        ...
+    ValueError: No current point
     '''
-    x displacement for given angle theta (degrees)
+    try:
+        return DEVICE['Path'][-1]
+    except IndexError as failure:
+        raise ValueError('No current point') from failure
+
+def string_end(source, start):
     '''
-    return math.cos(math.radians(theta))
+    index just past the parenthesis closing the string opened at `start`
+
+    nested parentheses are balanced, as in PostScript; only the parentheses
+    themselves are looked at, so this is linear in the length of the string
+
+    >>> string_end('(a (nested) string) and more', 0)
+    19
+    >>> string_end('(not closed', 0)
+    Traceback (most recent call last):
+        ...
+    ValueError: String not closed
+    '''
+    depth = 0
+    for paren in PARENS.finditer(source, start):
+        depth += 1 if paren.group() == '(' else -1
+        if not depth:
+            return paren.end()
+    raise ValueError('String not closed')
 
 def get_vertex(point):
     '''
-    return index into VERTEX for given point
+    return index of the vertex for given point
 
     must be 1-based to use in face ('f') statement
+
+    a new vertex is written to the .obj file straight away, so only the
+    index is kept in memory
+
+    points are identified by their x, y, z values only, so the same location
+    reached by different path types shares one vertex. with SNAP set, they
+    are first rounded to a grid of that size, so that points differing only
+    by floating point noise are also shared. the default, 1/1024 of a point,
+    is far below what any printer can resolve.
+
+    >>> VERTEX_INDEX.clear(); OUTPUT.obj = io.StringIO()
+    >>> get_vertex(Triplet(1, 2, 3, 'moveto')), get_vertex(Triplet(1, 2, 3))
+    (0, 0)
+    >>> print(OUTPUT.obj.getvalue(), end='')
+    v 1 2 3 # moveto
+    >>> get_vertex(Triplet(0.1 + 0.2, 0, 0)), get_vertex(Triplet(0.3, 0, 0))
+    (1, 1)
+    >>> get_vertex(Triplet(0.3 + 1 / 256, 0, 0))
+    2
+    >>> OUTPUT.obj = io.StringIO()  # large values keep their fractions
+    >>> get_vertex(Triplet(12345.678901, -1234.5678, 0))
+    3
+    >>> print(OUTPUT.obj.getvalue(), end='')
+    v 12345.6789 -1234.5678 0 # None
     '''
-    try:
-        index = VERTEX.index(point)
-    except ValueError:
-        VERTEX.append(point)
-        index = len(VERTEX) - 1
+    if SNAP:
+        key = (round(point.x / SNAP), round(point.y / SNAP),
+               round(point.z / SNAP))
+    else:
+        key = (point.x, point.y, point.z)
+    index = VERTEX_INDEX.get(key)
+    if index is None:
+        index = VERTEX_INDEX[key] = len(VERTEX_INDEX)
+        OUTPUT.obj.write('v %.9g %.9g %.9g # %s\n' % point)
     return index
 
-def join(index, segments):
+def write_faces(faces):
+    '''
+    write faces, each a sequence of 1-based vertex indices, to the .obj file
+
+    >>> OUTPUT.obj = io.StringIO()
+    >>> write_faces([(1, 2, 3), [4, 3, 2, 1]])
+    >>> print(OUTPUT.obj.getvalue(), end='')
+    f 1 2 3
+    f 4 3 2 1
+    '''
+    formats = FACE_FORMAT
+    lines = []
+    for face in faces:
+        size = len(face)
+        if size not in formats:
+            formats[size] = 'f' + ' %d' * size + '\n'
+        lines.append(formats[size] % tuple(face))
+    OUTPUT.obj.write(''.join(lines))
+
+def merge_colinear(path, tolerance=COLINEAR):
+    '''
+    drop points of the path that lie on a straight line between neighbors
+
+    consecutive segments heading the same way, to within `tolerance`
+    radians, become a single segment; this saves vertices and faces, and
+    `join` cannot intersect parallel lines anyway. points repeating the one
+    before, which would make zero-length segments, are dropped first.
+
+    >>> path = [Triplet(0, 0), Triplet(1, 1), Triplet(2, 2), Triplet(2, 3)]
+    >>> [point[:2] for point in merge_colinear(path)]
+    [(0, 0), (2, 2), (2, 3)]
+    >>> path = [Triplet(0, 0), Triplet(2, 0), Triplet(1, 0)]  # doubles back
+    >>> [point[:2] for point in merge_colinear(path)]
+    [(0, 0), (2, 0), (1, 0)]
+    >>> path = [Triplet(0, 0), Triplet(2, 0), Triplet(2, 0, 0, 'closepath')]
+    >>> [point.type for point in merge_colinear(path)]
+    [None, 'closepath']
+    '''
+    points = [path[0]]
+    for point in path[1:]:
+        if point == points[-1]:  # zero-length segment
+            points[-1] = point  # keeping the later type, e.g. closepath
+        else:
+            points.append(point)
+    if len(points) < 2:
+        return path  # only a dot, leave it to `stroke` as it is
+    path = points
+    if len(path) < 3:
+        return path
+    merged = [path[0]]
+    for point, after in zip(path[1:-1], path[2:]):
+        before = merged[-1]  # start of the current run
+        run_x, run_y = point.x - before.x, point.y - before.y
+        next_x, next_y = after.x - point.x, after.y - point.y
+        # sine of the turn is cross product over the product of the lengths
+        cross = run_x * next_y - run_y * next_x
+        lengths = math.hypot(run_x, run_y) * math.hypot(next_x, next_y)
+        if run_x * next_x + run_y * next_y > 0 and \
+                abs(cross) <= tolerance * lengths:
+            continue  # point is on the way from `before` to `after`
+        merged.append(point)
+    merged.append(path[-1])
+    return merged
+
+def build_segment_vertices(path, halfwidth, linewidth):
+    '''
+    corners of the box that `stroke` builds around each segment of `path`
+
+    pure geometry, no vertices are registered; returns one list of 8 Triplets
+    per segment, in the order expected by `get_faces` in `stroke`: port bow,
+    port quarter, starboard quarter and starboard bow on the deck, then the
+    same four on the hull below.
+
+    >>> box = build_segment_vertices([Triplet(0, 0), Triplet(10, 0)], 2, 3)[0]
+    >>> [point[:3] for point in box[:4]]
+    [(10.0, 2.0, 3), (0.0, 2.0, 3), (0.0, -2.0, 3), (10.0, -2.0, 3)]
+    >>> [point[:3] for point in box[4:]]
+    [(10.0, 2.0, 0), (0.0, 2.0, 0), (0.0, -2.0, 0), (10.0, -2.0, 0)]
+    >>> box = build_segment_vertices([Triplet(0, 0), Triplet(0, -10)], 2, 3)[0]
+    >>> [point[:2] for point in box[:4]]
+    [(2.0, -10.0), (2.0, 0.0), (-2.0, 0.0), (-2.0, -10.0)]
+    '''
+    boxes = []
+    for start, end in zip(path, path[1:]):
+        # sine and cosine of the heading straight from the segment itself,
+        # no need for angles and trig functions
+        delta_x, delta_y = end.x - start.x, end.y - start.y
+        # most strokes run along an axis, needing no hypot nor division;
+        # a zero-length segment is treated as heading along the x axis
+        if delta_y == 0:
+            sin_offset, cos_offset = 0.0, math.copysign(halfwidth, delta_x)
+        elif delta_x == 0:
+            sin_offset, cos_offset = math.copysign(halfwidth, delta_y), 0.0
+        else:
+            length = math.hypot(delta_x, delta_y)
+            sin_offset = delta_y / length * halfwidth
+            cos_offset = delta_x / length * halfwidth
+        if DEBUG:
+            logging.debug('stroking between %s and %s, offsets %s, %s',
+                          start, end, sin_offset, cos_offset)
+        # plain coordinates rather than Triplet arithmetic, which would
+        # build a throwaway Triplet for every offset
+        port_bow = (end.x - sin_offset, end.y + cos_offset)
+        port_quarter = (start.x - sin_offset, start.y + cos_offset)
+        starboard_quarter = (start.x + sin_offset, start.y - cos_offset)
+        starboard_bow = (end.x + sin_offset, end.y - cos_offset)
+        boxes.append([
+            Triplet(*point, z)
+            for z in (start.z + linewidth, start.z)
+            for point in (
+                port_bow, port_quarter, starboard_quarter, starboard_bow
+            )
+        ])
+    return boxes
+
+def join(trailing, leading):
     '''
     make a seamless join where two segments meet
 
-    modifies `segments` list in-place (calling routine recieves changes)
+    modifies the boxes in-place (calling routine recieves changes)
 
     this is a bit complicated. remember:
-    `segments` is a list of line segments forming a path: [SEG, SEG, ...]
-    each SEG is a dict: {'top': [V, V, V, V], 'bottom': [V, V, V, V], ...}
-    each V is a 1-based index into VERTEX
-    VERTEX[V - 1] is a Triplet of (x, y, z)
+    `trailing` and `leading` are the boxes around two consecutive line
+    segments of a path, as returned by `build_segment_vertices`.
+    each is a list of 8 Triplets: the port bow, port quarter, starboard
+    quarter and starboard bow on deck, then the same on the hull below.
     first, we want to determine the intersection of the port lines of
-    each segment, then modify those vertices to the intersection point.
+    each segment, then move those corners to the intersection point.
     then do the same with the starboard lines.
 
-    each point belongs to 3 faces of "this" segment, and 3 faces of the next
-    segment, so all need to be corrected with any new values.
-    '''
-    port_leading = [  # listed stern to bow for each grouping
-        VERTEX[segments[index]['top'][1] - 1],
-        VERTEX[segments[index]['top'][0] - 1]
-    ]
-    port_trailing = [
-        VERTEX[segments[index - 1]['top'][1] - 1],
-        VERTEX[segments[index - 1]['top'][0] - 1]
-    ]
-    starboard_leading = [
-        VERTEX[segments[index]['top'][2] - 1],
-        VERTEX[segments[index]['top'][3] - 1]
-    ]
-    starboard_trailing = [
-        VERTEX[segments[index - 1]['top'][2] - 1],
-        VERTEX[segments[index - 1]['top'][3] - 1]
-    ]
-    logging.debug('join: segments: %s, %s', port_leading, port_trailing)
-    new_point = intersection(
-        *[line_formula(*line)
-          for line in [port_leading, port_trailing]])
-    logging.debug('intersection: %s', new_point)
+    this is done before any vertices are registered, so the corners that
+    are moved never end up in the .obj file.
+
+    >>> boxes = build_segment_vertices(
+    ...     [Triplet(0, 0), Triplet(10, 0), Triplet(10, 10)], 1, 2)
+    >>> join(*boxes)
+    >>> boxes[0][0] == boxes[1][1] == Triplet(9, 1, 2)
+    True
+    >>> boxes[0][7] == boxes[1][6] == Triplet(11, -1, 0)
+    True
+    >>> boxes = build_segment_vertices(
+    ...     [Triplet(0, 0), Triplet(10, 0), Triplet(5, 0)], 1, 2)
+    >>> join(*boxes)  # doubling back, left as it is
+    >>> boxes[0][0][:2], boxes[1][1][:2]
+    ((10.0, 1.0), (10.0, -1.0))
+    >>> boxes = build_segment_vertices(
+    ...     [Triplet(0, 0), Triplet(30, 70), Triplet(15, 35)], 1.5, 3)
+    >>> join(*boxes)  # doubling back on a diagonal, not exactly parallel
+    >>> round(max(abs(value) for box in boxes for point in box
+    ...           for value in point[:3]), 2)  # nothing flung to infinity
+    70.59
+    '''
+    # parallel segments need no join: heading the same way, their corners
+    # already meet; doubling back, their sides never intersect, though
+    # rounding may put the intersection somewhere far off. so, as in
+    # `merge_colinear`, the sine of the turn (the cross product over the
+    # product of the lengths) is tested, not the cross product itself
+    leading_x = leading[0].x - leading[1].x
+    leading_y = leading[0].y - leading[1].y
+    trailing_x = trailing[0].x - trailing[1].x
+    trailing_y = trailing[0].y - trailing[1].y
+    cross = leading_x * trailing_y - leading_y * trailing_x
+    lengths = math.hypot(leading_x, leading_y) * \
+        math.hypot(trailing_x, trailing_y)
+    if abs(cross) <= COLINEAR * lengths:
+        return
+    port_leading = [leading[1], leading[0]]  # listed stern to bow
+    port_trailing = [trailing[1], trailing[0]]
+    starboard_leading = [leading[2], leading[3]]
+    starboard_trailing = [trailing[2], trailing[3]]
+    if DEBUG:
+        logging.debug('join: segments: %s, %s', port_trailing, port_leading)
+    new_point = line_intersect(*port_trailing, *port_leading)
+    if DEBUG:
+        logging.debug('intersection: %s', new_point)
     # port bow of the first segment, and port quarter of second, now
     # become the point of intersection
-    # pylint: disable=invalid-sequence-index  # get rid of bogus lint error
-    vertex = get_vertex(new_point) + 1
-    segments[index - 1]['top'][0] = segments[index]['top'][1] = \
-        segments[index - 1]['left'][3] = segments[index]['left'][2] = \
-        segments[index - 1]['end'][0] = segments[index]['start'][1] = vertex
+    trailing[0] = leading[1] = new_point
     # hull below, assume z should be 0 (?FIXME)  # pylint: disable=fixme
-    vertex = get_vertex(new_point._replace(z=0)) + 1
-    segments[index - 1]['bottom'][3] = segments[index]['bottom'][2] = \
-        segments[index - 1]['left'][0] = segments[index]['left'][1] = \
-        segments[index - 1]['end'][1] = segments[index]['start'][0] = vertex
+    trailing[4] = leading[5] = new_point._replace(z=0)
     # now the same for the starboard lines
-    new_point = intersection(
-        *[line_formula(*line)
-          for line in [starboard_leading, starboard_trailing]])
-    logging.debug('intersection: %s', new_point)
-    vertex = get_vertex(new_point) + 1
-    segments[index - 1]['top'][3] = segments[index]['top'][2] = \
-        segments[index - 1]['right'][0] = segments[index]['right'][1] = \
-        segments[index - 1]['end'][3] = segments[index]['start'][2] = vertex
-    vertex = get_vertex(new_point._replace(z=0)) + 1
-    segments[index - 1]['bottom'][0] = segments[index]['bottom'][1] = \
-        segments[index - 1]['right'][3] = segments[index]['right'][2] = \
-        segments[index - 1]['end'][2] = segments[index]['start'][3] = vertex
-
-def line_formula(start, end):
-    '''
-    calculate formula `y = mx + c` for line from two points
-
-    where m = delta y divided by delta x. if delta x is zero, it's a vertical
-    line, so simply return the formula `x = c`.
-
-    for purposes of this program, also return `z` value from start, which is
-    assumed to be same as end.
-
-    >>> sorted(line_formula(Triplet(0, 0), Triplet(3, 3)).items())
-    [('c', 0.0), ('m', 1.0), ('z', 0)]
-    >>> sorted(line_formula(Triplet(4, 4), Triplet(6, 4)).items())
-    [('c', 4.0), ('m', 0.0), ('z', 0)]
-    >>> sorted(line_formula(Triplet(4, 4, 3), Triplet(4, 6)).items())
-    [('x', 4), ('z', 3)]
-    '''
-    delta_y = end.y - start.y
-    delta_x = end.x - start.x
-    if delta_x == 0:
-        formula = {'x': start.x}
-    else:
-        formula = {'m': delta_y / delta_x}
-        # now calculate c using either point
-        formula['c'] = start.y - formula['m'] * start.x
-    logging.debug('delta_x: %s, delta_y: %s, formula: %s',
-                  delta_x, delta_y, formula)
-    formula['z'] = start.z
-    return formula
+    new_point = line_intersect(*starboard_trailing, *starboard_leading)
+    if DEBUG:
+        logging.debug('intersection: %s', new_point)
+    trailing[3] = leading[2] = new_point
+    trailing[7] = leading[6] = new_point._replace(z=0)
 
-def intersection(line0, line1):
+def line_intersect(start0, end0, start1, end1):
     '''
-    calculate intersection of two lines, given their formulas
+    intersection of the line through start0 and end0 with that through
+    start1 and end1
 
-    this assumes that the lines are different and that they do
-    indeed intersect; it is meant for purposes of this program and
-    not as a general solution.
+    solves the two parametric equations by Cramer's rule: no formulas to
+    build, and no special case for vertical lines. the z value is taken
+    from start0.
 
-    for example, line0: m = 1, c = 0 and line1: m = -1, c = -5
-    putting the slopes on one side and the constants on the other, you get
-    2x = -5, yielding x = -2.5, and thus y by the first formula,
-    1 * -2.5 + 0, is also -2.5.
+    parallel lines have no intersection, so the midpoint of end0 and start1,
+    where the first line is taken to hand over to the second, is returned
+    instead. `join` doesn't get this far with parallel lines anyway.
 
-    >>> intersection({'m': 1, 'c': 0}, {'m': 0, 'c': 4})
+    >>> line_intersect(Triplet(0, 0), Triplet(3, 3),
+    ...                Triplet(0, 4), Triplet(6, 4))
     Triplet(x=4.0, y=4.0, z=0, type=None)
-    >>> intersection({'m': 1, 'c': 2.12}, {'m': 0, 'c': 11.5})
-    Triplet(x=9.379999999999999, y=11.5, z=0, type=None)
-    >>> intersection({'m': 0, 'c': 11.5}, {'m': 1, 'c': 2.12})  # order matters?
-    Triplet(x=9.379999999999999, y=11.5, z=0, type=None)
-    '''
-    logging.debug('calculating intersection of lines %s and %s', line0, line1)
-    if 'm' in line0 and 'm' in line1:
-        # put the `mx`s on one side of the equation and `c`s on the other
-        # then divide by the x multiplier, leaving x
-        x_value = (line1['c'] - line0['c']) / (line0['m'] - line1['m'])
-    elif 'x' in line0:
-        line0, line1 = line1, line0  # swap them
-        x_value = line1['x']
-    y_value = line0['m'] * x_value + line0['c']
-    logging.debug('intersection: (%.3f, %.3f)', x_value, y_value)
-    return Triplet(x_value, y_value, line0.get('z', 0))
+    >>> line_intersect(Triplet(9, 0, 2), Triplet(9, 10, 2),
+    ...                Triplet(0, 1, 2), Triplet(10, 1, 2))
+    Triplet(x=9.0, y=1.0, z=2, type=None)
+    >>> line_intersect(Triplet(0, 1), Triplet(10, 1),
+    ...                Triplet(10, -1), Triplet(5, -1))
+    Triplet(x=10.0, y=0.0, z=0, type=None)
+    '''
+    delta_x0, delta_y0 = end0.x - start0.x, end0.y - start0.y
+    delta_x1, delta_y1 = end1.x - start1.x, end1.y - start1.y
+    determinant = delta_x0 * delta_y1 - delta_y0 * delta_x1
+    if determinant == 0:
+        return Triplet((end0.x + start1.x) / 2, (end0.y + start1.y) / 2,
+                       start0.z)
+    along = ((start1.x - start0.x) * delta_y1 -
+             (start1.y - start0.y) * delta_x1) / determinant
+    return Triplet(start0.x + along * delta_x0, start0.y + along * delta_y0,
+                   start0.z)
 
 def ps3d():
     '''
     words which define the ps3d language
+
+    the words are nested in here, out of doctest's sight, so the examples
+    for them are kept here instead
+
+    >>> PS3D.update(ps3d())
+    >>> STACK[:] = []
+    >>> execute(compile_ps3d('1 2 3 4 5  4 1 roll'))
+    >>> STACK
+    [1, 5, 2, 3, 4]
+    >>> execute(compile_ps3d('3 -1 roll'))
+    >>> STACK
+    [1, 5, 3, 4, 2]
+    >>> execute(compile_ps3d('4 6 roll  4 0 roll'))  # as `4 2 roll`
+    >>> STACK
+    [1, 4, 2, 5, 3]
+    >>> STACK[:] = []
+    >>> execute(compile_ps3d('1 2 moveto  3 7 rmoveto'))
+    >>> DEVICE['Path'], STACK
+    ([Triplet(x=4, y=9, z=0, type='moveto')], [])
+    >>> execute(compile_ps3d('gsave 1 1 rlineto currentpagedevice /Path get'))
+    >>> execute(compile_ps3d('grestore'))  # leaves the path on STACK alone
+    >>> len(STACK.pop()), DEVICE['Path']
+    (2, [Triplet(x=4, y=9, z=0, type='moveto')])
+    >>> DEVICE['Path'] = []
     '''
     # pylint: disable=possibly-unused-variable
     # pylint: disable=too-many-statements, too-many-locals  # can't be helped
+    # pylint: disable=unbalanced-tuple-unpacking  # STACK filled at run time
+    # STACK's methods, bound once for the words below (STACK is never
+    # rebound, only modified); these are not words themselves
+    _pop, _push, _extend = STACK.pop, STACK.append, STACK.extend
+
     def add():
-        STACK.append(STACK.pop() + STACK.pop())
+        addend = _pop()
+        # the augend is replaced by the sum, but not with `+=`, which would
+        # change a list operand (such as DEVICE['RGBColor']) in place
+        STACK[-1] = STACK[-1] + addend
 
     def _print():
-        print('# stdout:', STACK.pop(), file=OUTPUT.obj)
+        print('# stdout:', _pop(), file=OUTPUT.obj)
 
     def currentpoint():
-        try:
-            here = DEVICE['Path'][-1]
-        except IndexError as failure:
-            raise ValueError('No current point') from failure
-        STACK.extend([here.x, here.y])
+        here = current_point()
+        _extend([here.x, here.y])
 
     def roll():
         '''
-        STACK = [1, 2, 3, 4]
-        STACK.extend([4, 2])
-        roll()
-        STACK
-        [3, 4, 1, 2]
+        roll the top `number` items on the STACK up by `count` places
+
+        done as one slice rotation, however big the count; a negative count
+        rolls them down
         '''
-        count, number = STACK.pop(), STACK.pop()
-        if count < 0:
-            while count:
-                STACK.append(STACK.pop(-number))
-                count += 1
-        elif count > 0:
-            while count:
-                STACK.insert(-number, STACK.pop())
-                count -= 1
+        number, count = popn(2)
+        if number > len(STACK):
+            raise IndexError('STACK underflow')
+        if number > 0:
+            count %= number
+            if count:
+                STACK[-number:] = STACK[-count:] + STACK[-number:-count]
 
     def index():
         '''
@@ -373,55 +750,52 @@ def ps3d():
         >>> STACK
         [1, 2.2, 3, 4, 2.2]
         '''
-        STACK.append(STACK[-STACK.pop() - 1])
+        _push(STACK[-_pop() - 1])
 
     def moveto(pathtype='moveto'):
+        x_value, y_value = popn(2)
         path = DEVICE['Path'] = []  # clear current path
-        path.append(Triplet(STACK.pop(-2), STACK.pop(), 0, pathtype))
+        path.append(Triplet(x_value, y_value, 0, pathtype))
 
     def rmoveto(pathtype='moveto'):
-        '''
-        >>> STACK[:] = [1, 2]
-        >>> moveto()
-        >>> STACK[:] = [3, 7]
-        >>> rmoveto()
-        >>> DEVICE['Path'][-1]
-        []
-        '''
-        # add y together then x
-        process('currentpoint 2 1 roll add exch 2 1 roll add exch')
+        delta_x, delta_y = popn(2)
+        here = current_point()
+        _extend([here.x + delta_x, here.y + delta_y])
         return moveto(pathtype)
 
     def lineto(pathtype='lineto'):
-        displacement = Triplet(STACK.pop(-2), STACK.pop(), 0, pathtype)
-        here = Triplet(STACK.pop(-2), STACK.pop())
-        logging.debug('%s from %s to %s', pathtype, here, displacement)
+        here_x, here_y, x_value, y_value = popn(4)
+        displacement = Triplet(x_value, y_value, 0, pathtype)
+        if DEBUG:
+            logging.debug('%s from %s to %s', pathtype,
+                          Triplet(here_x, here_y), displacement)
         DEVICE['Path'].append(displacement)
 
     def rlineto(pathtype='lineto'):
-        # add y together then x
-        process('currentpoint 4 2 roll 2 index add exch 3 index add exch')
+        delta_x, delta_y = popn(2)
+        here = current_point()
+        _extend([here.x, here.y, here.x + delta_x, here.y + delta_y])
         return lineto(pathtype)
 
     def closepath(pathtype='closepath'):
         path = DEVICE['Path']
         currentpoint()
-        STACK.extend([path[0].x, path[0].y])
+        _extend([path[0].x, path[0].y])
         return lineto(pathtype)
 
     def currentpagedevice():
-        STACK.append(DEVICE)
+        _push(DEVICE)
 
     def get():
-        index = STACK.pop()
-        STACK.append(STACK.pop().__getitem__(index))
+        index = _pop()
+        _push(_pop().__getitem__(index))
 
     def div():
-        divisor = STACK.pop()
-        STACK.append(STACK.pop() / divisor)
+        divisor = _pop()
+        STACK[-1] /= divisor  # the dividend is replaced by the quotient
 
     def dup():
-        STACK.append(STACK[-1])
+        _push(STACK[-1])
 
     def exch():
         STACK[-2], STACK[-1] = STACK[-1], STACK[-2]
@@ -432,23 +806,28 @@ def ps3d():
 
         easier to see problems with white items in MeshLab than with black
         '''
-        color = [STACK.pop(-3), STACK.pop(-2), STACK.pop()]
+        color = popn(3)
         if color == BLACK and not useblack:
             color = WHITE
         if color != DEVICE['RGBColor']:
             DEVICE['RGBColor'] = color
-            logging.debug('color now: %s', DEVICE['RGBColor'])
-            if color in COLOR:
-                logging.debug('color %s already in COLOR: %s', color, COLOR)
-                group = 'mtl%d' % COLOR.index(color)
+            if DEBUG:
+                logging.debug('color now: %s', DEVICE['RGBColor'])
+            key = tuple(color)
+            index = COLOR_INDEX.get(key)
+            if index is not None:
+                if DEBUG:
+                    logging.debug('color %s already in COLOR: %s',
+                                  color, COLOR)
+                group = 'mtl%d' % index
             else:
                 group = 'mtl%d' % len(COLOR)
+                COLOR_INDEX[key] = len(COLOR)
                 COLOR.append(color)
-                print('', file=OUTPUT.mtl)
-                print('newmtl', group, file=OUTPUT.mtl)
-                print('Kd', *color, file=OUTPUT.mtl)
-            print('g', group, file=OUTPUT.obj)
-            print('usemtl', group, file=OUTPUT.obj)
+                OUTPUT.mtl.write(
+                    '\nnewmtl %s\nKd %s %s %s\n' % (group, *color)
+                )
+            OUTPUT.obj.write('g %s\nusemtl %s\n' % (group, group))
         else:
             logging.info('color was already %s', color)
 
@@ -456,27 +835,40 @@ def ps3d():
         if STACK[-1] == 0:
             logging.warning('using white not black, see .obj file for details')
             print('# use 0 0 0 setrgbcolor for black', file=OUTPUT.obj)
-        STACK.extend([STACK.pop()] * 3)
+        _extend([_pop()] * 3)
         setrgbcolor(useblack)
 
     def gsave():
-        GSTACK.append(deepcopy(DEVICE))
+        '''
+        save a copy of the graphics state
+
+        everything in DEVICE is either immutable or replaced rather than
+        modified, except that the path is appended to in place. so rather
+        than copy the path, only its length is saved, for `grestore` to cut
+        it back to; saving takes the same time however long the path.
+        '''
+        GSTACK.append((dict(DEVICE), len(DEVICE['Path'])))
 
     def grestore():
-        DEVICE.update(GSTACK.pop())
+        state, length = GSTACK.pop()
+        DEVICE.update(state)
+        path = DEVICE['Path']
+        # paths only grow in place, so one still that long is unchanged;
+        # otherwise a copy, not cut back in place, as it may be on the STACK
+        DEVICE['Path'] = path if len(path) == length else path[:length]
 
     def setlinewidth():
-        DEVICE['LineWidth'] = STACK.pop()
+        DEVICE['LineWidth'] = _pop()
 
     def run():
-        filespec = STACK.pop()
+        filespec = _pop()
         infile = open(filespec)
         process_file(infile)
         infile.close()
 
     def _def():
-        definition = STACK.pop()
-        name = STACK.pop()
+        definition = _pop()
+        name = _pop()
         PS3D.update({name: definition})
 
     def fill():
@@ -492,19 +884,20 @@ def ps3d():
             raise ValueError('Width less than a millimeter not likely to work')
         if path[-1].type != 'closepath':
             raise ValueError('Operation `fill` requires closed path')
-        top = [p._replace(z=linewidth) for p in path]
+        # each vertex is looked up once, then reused by all its faces
+        top = [get_vertex(p._replace(z=linewidth)) + 1 for p in path]
+        bottom = [get_vertex(p) + 1 for p in path]
         # NOTE order may well be wrong (clockwise) for top and bottom
         # remember that DEVICE['Path'] has one extra element, `closepath`
-        FACE.append([get_vertex(p) + 1 for p in top[:-1]])  # add top face
+        faces = [top[:-1]]  # add top face
         for index in range(1, len(path)):  # add the sides
-            logging.debug('fill: index=%d', index)
-            FACE.append([
-                get_vertex(top[index]) + 1,
-                get_vertex(top[index - 1]) + 1,
-                get_vertex(path[index - 1]) + 1,
-                get_vertex(path[index]) + 1
+            if DEBUG:
+                logging.debug('fill: index=%d', index)
+            faces.append([
+                top[index], top[index - 1], bottom[index - 1], bottom[index]
             ])
-        FACE.append([get_vertex(p) + 1 for p in reversed(path[:-1])])  # bottom
+        faces.append(bottom[-2::-1])  # bottom, reversed
+        write_faces(faces)
         DEVICE['Path'] = []  # clear path after fill
 
     def stroke():
@@ -514,21 +907,22 @@ def ps3d():
         using line width as thickness for now; it should probably be at least
         3 PostScript units, about 1mm, to be rendered properly by 3D printer
         '''
-        path = DEVICE['Path']
         linewidth = DEVICE['LineWidth']
         if linewidth * MM < 1:
             raise ValueError('Width less than a millimeter not likely to work')
+        if len(DEVICE['Path']) < 2:  # no segments, so nothing to draw
+            DEVICE['Path'] = []
+            return
+        path = merge_colinear(DEVICE['Path'])
         halfwidth = linewidth / 2
-        logging.debug('half line width: %s mm', halfwidth)
-        segments = []
-        # we need to make 3 loops, building boxes around the path segments;
-        # the outmost loop iterates over the segments;
-        # the next inner loop creates the faces: top, bottom, left, right;
-        # the innermost loop creates the vertices.
-        # vertices can and should be reused
-        # should add a face to each end of the resulting path
-
-        def get_faces(start, end):
+        if DEBUG:
+            logging.debug('half line width: %s points', halfwidth)
+        # a box is built around each segment of the path, then a single pass
+        # joins each box to the next, registers its vertices (shared with
+        # its neighbours) and collects its faces, with a cap at either end
+        # of an open path
+
+        def get_faces(box):
             '''
             think of the segment as a ship going from start to end
 
@@ -542,59 +936,48 @@ def ps3d():
             so when, for example, the hull and deck are swapped, the
             numbering becomes 8, 7, 6, 5.
             '''
-            theta = atan2(start, end)
-            logging.debug('stroking between %s and %s, angle %s degrees',
-                          path[index], path[index + 1], theta)
-            adjustment = halfwidth
-            sin_offset = sin(theta) * adjustment
-            cos_offset = cos(theta) * adjustment
-            vertices = [get_vertex(point) for point in (
-                end + Triplet(-sin_offset, cos_offset, linewidth),
-                start + Triplet(-sin_offset, cos_offset, linewidth),
-                start + Triplet(sin_offset, -cos_offset, linewidth),
-                end + Triplet(sin_offset, -cos_offset, linewidth),
-                end + Triplet(-sin_offset, cos_offset),
-                start + Triplet(-sin_offset, cos_offset),
-                start + Triplet(sin_offset, -cos_offset),
-                end + Triplet(sin_offset, -cos_offset)
-            )]
-            logging.debug('vertices: %s', vertices)
+            vertices = [vertex(point) + 1 for point in box]  # 1-based
+            if DEBUG:
+                logging.debug('vertices: %s', vertices)
             faces = {
-                'top': list(vertices[i - 1] + 1 for i in [1, 2, 3, 4]),
-                'bottom': list(vertices[i - 1] + 1 for i in [8, 7, 6, 5]),
-                'left': list(vertices[i - 1] + 1 for i in [5, 6, 2, 1]),
-                'right': list(vertices[i - 1] + 1 for i in [4, 3, 7, 8]),
-                'start': list(vertices[i - 1] + 1 for i in [2, 6, 7, 3]),
-                'end': list(vertices[i - 1] + 1 for i in [5, 1, 4, 8]),
+                name: (vertices[a], vertices[b], vertices[c], vertices[d])
+                for name, (a, b, c, d) in BOX_FACES.items()
             }
             return faces
 
-        for index in range(len(path) - 1):
-            segments.append(get_faces(path[index], path[index + 1]))
-        # now join the segments seamlessly
-        for index in range(1, len(segments)):
-            join(index, segments)
-
-        offset = len(FACE)
-        for segment in segments:
-            FACE.extend([
-                segment[k] for k in ('top', 'left', 'bottom', 'right')
-            ])
-        if path[-1].type != 'closepath':
-            FACE.insert(offset, segments[0]['start'])  # near end cap
-            FACE.append(segments[-1]['end'])  # far end cap
-        else:
-            join(1, [segments[-1], segments[0]])
+        boxes = build_segment_vertices(path, halfwidth, linewidth)
+        closed = path[-1].type == 'closepath'
+        if closed:  # join the ends first, so the first box is done early
+            join(boxes[-1], boxes[0])
+        vertex = get_vertex  # local for the get_faces loop
+        faces = []
+        add_faces = faces.extend
+        # join the segments seamlessly in a single pass: once joined to
+        # the next, a box's corners are final and its vertices can be
+        # registered
+        for box, following in zip(boxes, boxes[1:] + [None]):
+            if following is not None:
+                join(box, following)
+            segment = get_faces(box)
+            if box is boxes[0] and not closed:
+                faces.append(segment['start'])  # near end cap
+            add_faces((segment['top'], segment['left'],
+                       segment['bottom'], segment['right']))
+        if not closed:
+            faces.append(segment['end'])  # far end cap
+        write_faces(faces)
 
         DEVICE['Path'] = []  # clear path after stroke
 
     def showpage():
-        for vertex in VERTEX:
-            print('v %f %f %f # %s' % vertex, file=OUTPUT.obj)
-        for face in FACE:
-            print('f', *face, file=OUTPUT.obj)
+        '''
+        nothing left to do: `fill` and `stroke` write their vertices and
+        faces to the .obj file as they go
+        '''
 
     words = locals()
+    for alias in ('_pop', '_push', '_extend'):
+        del words[alias]
     words['='] = _print
     words['def'] = _def
     return words